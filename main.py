@@ -1,16 +1,26 @@
 import os
-import json
-import subprocess
+import copy
+import hashlib
+import orjson
 import tempfile
 import shutil
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
-from pydantic import BaseModel, HttpUrl
-from typing import Optional, List, Dict, Any
+from fastapi.responses import Response, StreamingResponse, JSONResponse, RedirectResponse
+from pydantic import BaseModel, ConfigDict, HttpUrl
+from typing import Optional, List, Dict, Any, Tuple
 import uuid
 import asyncio
 import re
+import logging
+from cachetools import TLRUCache
+from aiocache import Cache
+from aiocache.serializers import BaseSerializer
+from yt_dlp import YoutubeDL
+from yt_dlp.version import __version__ as YT_DLP_VERSION
+from yt_dlp.utils import DownloadError, YoutubeDLError
+
+logger = logging.getLogger("uvicorn.error")
 
 app = FastAPI(title="Universal Video Downloader API", version="2.0.0")
 
@@ -26,10 +36,111 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Video info cache - avoid re-running yt-dlp for URLs we've seen recently.
+# Live streams get a much shorter TTL since their formats go stale quickly.
+INFO_CACHE_TTL = int(os.getenv("INFO_CACHE_TTL", 600))
+INFO_CACHE_LIVE_TTL = int(os.getenv("INFO_CACHE_LIVE_TTL", 30))
+INFO_CACHE_SIZE = int(os.getenv("INFO_CACHE_SIZE", 2048))
+
+def info_ttl(info: Dict[str, Any]) -> int:
+    """Cache lifetime in seconds for extracted video info"""
+    return INFO_CACHE_LIVE_TTL if info.get('is_live') else INFO_CACHE_TTL
+
+info_cache: TLRUCache = TLRUCache(
+    maxsize=INFO_CACHE_SIZE,
+    ttu=lambda key, info, now: now + info_ttl(info)
+)
+info_pending: Dict[Tuple[str, bool], asyncio.Future] = {}
+
+class OrjsonSerializer(BaseSerializer):
+    """Store cached info in Redis as orjson-encoded bytes"""
+    DEFAULT_ENCODING = None
+    
+    def dumps(self, value: Any) -> bytes:
+        return orjson.dumps(value)
+    
+    def loads(self, value: Optional[bytes]) -> Any:
+        return None if value is None else orjson.loads(value)
+
+# Shared info cache across workers/replicas, enabled when REDIS_URL is set.
+# Keep the timeout short so a Redis outage doesn't stall every cache miss.
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS_TIMEOUT = float(os.getenv("REDIS_TIMEOUT", 0.5))
+shared_cache = Cache.from_url(REDIS_URL) if REDIS_URL else None
+if shared_cache is not None:
+    shared_cache.serializer = OrjsonSerializer()
+    shared_cache.timeout = REDIS_TIMEOUT
+
+# Let browsers/CDNs reuse metadata responses for a while
+METADATA_CACHE_CONTROL = "public, max-age=300, stale-while-revalidate=600"
+
+# Cap concurrent yt-dlp work to avoid CPU thrashing and bot detection
+YTDLP_SEM = asyncio.Semaphore(int(os.getenv("YTDLP_CONCURRENCY", 4)))
+# Separate cap on running download processes, held for the whole stream
+# so long downloads never starve /info of YTDLP_SEM slots
+YTDLP_STREAM_SEM = asyncio.Semaphore(int(os.getenv("YTDLP_STREAM_CONCURRENCY", 8)))
+
+# Options for in-process metadata extraction (equivalent of --dump-json)
+YDL_OPTS = {
+    'quiet': True,
+    'no_warnings': True,
+    'nocheckcertificate': True,
+    'noplaylist': True,
+    'skip_download': True,
+    'cachedir': False,
+    'source_address': '0.0.0.0',  # force IPv4
+    'socket_timeout': 15,
+}
+
+# Lightweight extraction - skips the YouTube watch page and player configs,
+# so fields like like_count/comment_count may come back empty
+YDL_LITE_OPTS = {
+    **YDL_OPTS,
+    'extractor_args': {'youtube': {'player_skip': ['webpage', 'configs']}},
+}
+
+# Static yt-dlp arguments for streaming a download to stdout
+YDLP_STREAM_ARGS = (
+    '-o', '-',
+    '--no-playlist',
+    '--no-warnings',
+    '--no-check-certificate',
+    '--prefer-free-formats',
+    '--no-progress',
+    '--no-config',
+    '--no-cache-dir',
+    '--force-ipv4',
+    '--socket-timeout', '15',
+)
+
+# Map quality to yt-dlp format - every entry ends in a selector that always
+# matches, so a missing resolution falls back to best instead of failing
+FORMAT_MAP = {
+    'best': 'best[ext=mp4]/best',
+    'worst': 'worst[ext=mp4]/worst',
+    '720p': 'best[height<=720][ext=mp4]/best[height<=720]/best[ext=mp4]/best',
+    '480p': 'best[height<=480][ext=mp4]/best[height<=480]/best[ext=mp4]/best',
+    '360p': 'best[height<=360][ext=mp4]/best[height<=360]/best[ext=mp4]/best'
+}
+
+# Read yt-dlp's stdout in large chunks to cut syscalls/event loop wakeups.
+# Bytes still pass through Python: uvicorn never hands the ASGI app the
+# client socket, so a pipe-to-socket os.splice() isn't possible here.
+STREAM_CHUNK_SIZE = 1 << 20
+# The StreamReader pauses the pipe once it buffers 2x this limit, so a slow
+# client throttles yt-dlp itself instead of piling up chunks in memory
+STREAM_BUFFER_LIMIT = STREAM_CHUNK_SIZE
+
+# Only the end of yt-dlp's stderr is kept for error reporting
+STDERR_TAIL_SIZE = 8 * 1024
+
 # Request/Response Models
 class DownloadRequest(BaseModel):
-    videoUrl: str
+    model_config = ConfigDict(extra='ignore', str_strip_whitespace=True)
+    
+    videoUrl: HttpUrl
     quality: Optional[str] = "best"
+    lite: bool = False
 
 class InfoResponse(BaseModel):
     title: str
@@ -51,55 +162,195 @@ class ErrorResponse(BaseModel):
     platform: Optional[str] = None
 
 # Utility Functions
+_UNSAFE_CHARS = re.compile(r'[^\w\s-]')
+_WHITESPACE_RUN = re.compile(r'\s+')
+# Same substitution as _UNSAFE_CHARS, as a C-level table for ASCII titles
+_SAFE_TABLE = str.maketrans({
+    c: '_' for c in map(chr, range(128))
+    if not (c.isalnum() or c.isspace() or c in '-_')
+})
+
 def sanitize_filename(filename: str) -> str:
     """Remove invalid characters from filename"""
-    filename = re.sub(r'[^\w\s-]', '_', filename)
-    filename = re.sub(r'\s+', '_', filename)
+    if filename.isascii():
+        filename = filename.translate(_SAFE_TABLE)
+    else:
+        filename = _UNSAFE_CHARS.sub('_', filename)
+    filename = _WHITESPACE_RUN.sub('_', filename)
     return filename[:200]  # Limit filename length
 
 def format_duration(seconds: Optional[int]) -> str:
     """Convert seconds to human readable format"""
     if not seconds:
         return "Unknown"
-    hours = seconds // 3600
-    minutes = (seconds % 3600) // 60
-    secs = seconds % 60
-    parts = []
-    if hours > 0:
-        parts.append(f"{hours}h")
-    if minutes > 0:
-        parts.append(f"{minutes}m")
-    if secs > 0 or not parts:
-        parts.append(f"{secs}s")
-    return " ".join(parts)
-
-async def stream_yt_dlp(url: str, quality: str = "best"):
-    """Stream yt-dlp output as a generator"""
-    cmd = [
-        'yt-dlp',
-        url,
-        '-f', f'{quality}[ext=mp4]/best[ext=mp4]/best',
-        '-o', '-',
-        '--no-playlist',
-        '--no-warnings',
-        '--no-call-home',
-        '--no-check-certificate',
-        '--prefer-free-formats',
-    ]
+    hours, rem = divmod(seconds, 3600)
+    minutes, secs = divmod(rem, 60)
+    if not hours:
+        if not minutes:
+            return f"{secs}s"
+        return f"{minutes}m {secs}s" if secs else f"{minutes}m"
+    if minutes:
+        return f"{hours}h {minutes}m {secs}s" if secs else f"{hours}h {minutes}m"
+    return f"{hours}h {secs}s" if secs else f"{hours}h"
+
+def _extract_info(url: str, lite: bool = False) -> Dict[str, Any]:
+    """Extract video info with the yt-dlp API (blocking)"""
+    with YoutubeDL(YDL_LITE_OPTS if lite else YDL_OPTS) as ydl:
+        info = ydl.extract_info(url, download=False)
+        # Drop private/requested_* keys, same as --dump-json emits
+        return ydl.sanitize_info(info, remove_private_keys=True)
+
+async def extract_info(url: str, lite: bool = False) -> Dict[str, Any]:
+    """Extract video info without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    try:
+        async with YTDLP_SEM:
+            return await loop.run_in_executor(None, _extract_info, url, lite)
+    except DownloadError as e:
+        raise HTTPException(status_code=400, detail=f"yt-dlp error: {e}")
+
+async def fetch_info(url: str, lite: bool = False) -> Dict[str, Any]:
+    """Get video info from the shared cache, extracting it on a miss"""
+    if shared_cache is None:
+        return await extract_info(url, lite)
     
-    process = await asyncio.create_subprocess_exec(
-        *cmd,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE
-    )
+    cache_key = f"info:lite:{url}" if lite else f"info:{url}"
+    try:
+        info = await shared_cache.get(cache_key)
+        if info is not None:
+            return info
+    except Exception as e:
+        logger.warning("Shared cache read failed: %r", e)
+    
+    info = await extract_info(url, lite)
+    
+    try:
+        await shared_cache.set(cache_key, info, ttl=info_ttl(info))
+    except Exception as e:
+        logger.warning("Shared cache write failed: %r", e)
+    
+    return info
+
+async def get_info(url: str, lite: bool = False) -> Dict[str, Any]:
+    """Get video info, served from cache when possible"""
+    key = (url, lite)
+    info = info_cache.get(key)
+    if info is not None:
+        return info
+    
+    # Concurrent requests for the same URL share a single yt-dlp run
+    pending = info_pending.get(key)
+    if pending is None:
+        pending = asyncio.ensure_future(fetch_info(url, lite))
+        info_pending[key] = pending
+        pending.add_done_callback(lambda _: info_pending.pop(key, None))
+    
+    info = await asyncio.shield(pending)
+    # Entries loaded from Redis restart their TTL here, so with REDIS_URL set
+    # an info can be served for up to twice info_ttl() in total
+    info_cache[key] = info
+    return info
+
+def cached_json_response(content: bytes, http_request: Request) -> Response:
+    """JSON response with Cache-Control and ETag, 304 if the client's copy is current"""
+    etag = f'"{hashlib.md5(content).hexdigest()}"'
+    headers = {
+        "Cache-Control": METADATA_CACHE_CONTROL,
+        "ETag": etag,
+        "Access-Control-Expose-Headers": "ETag"
+    }
+    
+    if_none_match = http_request.headers.get("if-none-match", "")
+    if etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+    
+    return Response(content=content, media_type="application/json", headers=headers)
+
+def _resolve_direct_url(info: Dict[str, Any], format_spec: str) -> Optional[str]:
+    """Select a format and return its media URL if clients can fetch it directly"""
+    with YoutubeDL({**YDL_OPTS, 'format': format_spec}) as ydl:
+        selected = ydl.process_ie_result(copy.deepcopy(info), download=False)
     
+    # Merged formats, HLS/DASH manifests and cookie-bound URLs need yt-dlp
+    if selected.get('requested_formats'):
+        return None
+    if selected.get('protocol') not in ('http', 'https'):
+        return None
+    if selected.get('cookies') or 'Cookie' in (selected.get('http_headers') or {}):
+        return None
+    return selected.get('url')
+
+async def resolve_direct_url(info: Dict[str, Any], format_spec: str) -> Optional[str]:
+    """Resolve a direct media URL without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(None, _resolve_direct_url, info, format_spec)
+    except YoutubeDLError:
+        # Covers format selection failures - let the streaming path handle it
+        return None
+
+async def read_stderr_tail(stream: asyncio.StreamReader) -> str:
+    """Drain a stderr pipe, keeping only the last STDERR_TAIL_SIZE bytes"""
+    tail = b''
     while True:
-        chunk = await process.stdout.read(8192)
+        chunk = await stream.read(STDERR_TAIL_SIZE)
         if not chunk:
             break
-        yield chunk
+        tail = (tail + chunk)[-STDERR_TAIL_SIZE:]
+    return tail.decode(errors='replace').strip()
+
+async def spawn_yt_dlp(info: Dict[str, Any], format_spec: str) -> Tuple[asyncio.subprocess.Process, asyncio.Task]:
+    """Start yt-dlp streaming to stdout from already extracted info"""
+    cmd = ('yt-dlp', '--load-info-json', '-', '-f', format_spec, *YDLP_STREAM_ARGS)
     
-    await process.wait()
+    async with YTDLP_SEM:
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            limit=STREAM_BUFFER_LIMIT
+        )
+        
+        # Feed the cached info so yt-dlp skips extraction entirely
+        process.stdin.write(orjson.dumps(info))
+        await process.stdin.drain()
+        process.stdin.close()
+    
+    # Keep stderr drained so a chatty yt-dlp never blocks on a full pipe
+    stderr_tail = asyncio.create_task(read_stderr_tail(process.stderr))
+    
+    return process, stderr_tail
+
+async def stream_yt_dlp(info: Dict[str, Any], format_spec: str = "best[ext=mp4]/best"):
+    """Stream yt-dlp output as a generator"""
+    await YTDLP_STREAM_SEM.acquire()
+    process = None
+    
+    try:
+        process, stderr_tail = await spawn_yt_dlp(info, format_spec)
+        
+        while True:
+            chunk = await process.stdout.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+        
+        await process.wait()
+        error_msg = await stderr_tail
+        if process.returncode != 0:
+            logger.warning("yt-dlp exited with code %s: %s", process.returncode, error_msg)
+    finally:
+        try:
+            # Client went away mid-stream - stop yt-dlp instead of letting it run on
+            if process is not None and process.returncode is None:
+                process.terminate()
+                try:
+                    await asyncio.wait_for(process.wait(), 2.0)
+                except asyncio.TimeoutError:
+                    process.kill()
+        finally:
+            YTDLP_STREAM_SEM.release()
 
 # Health Check
 @app.get("/")
@@ -118,49 +369,18 @@ async def root():
 @app.get("/health")
 async def health_check():
     """Health check endpoint for Railway"""
-    try:
-        # Check if yt-dlp is installed
-        result = subprocess.run(['yt-dlp', '--version'], capture_output=True, text=True)
-        yt_dlp_version = result.stdout.strip()
-    except:
-        yt_dlp_version = "not found"
-    
     return {
         "status": "healthy",
-        "yt-dlp_version": yt_dlp_version,
+        "yt-dlp_version": YT_DLP_VERSION,
         "python_version": os.sys.version
     }
 
 # Get Video Information
 @app.post("/info", response_model=InfoResponse)
-async def get_video_info(request: DownloadRequest):
+async def get_video_info(request: DownloadRequest, http_request: Request):
     """Get video information without downloading"""
     try:
-        # Run yt-dlp to get JSON info
-        cmd = [
-            'yt-dlp',
-            request.videoUrl,
-            '--dump-json',
-            '--no-playlist',
-            '--no-warnings',
-            '--no-call-home',
-            '--no-check-certificate'
-        ]
-        
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        
-        stdout, stderr = await process.communicate()
-        
-        if process.returncode != 0:
-            error_msg = stderr.decode().strip()
-            raise HTTPException(status_code=400, detail=f"yt-dlp error: {error_msg}")
-        
-        # Parse JSON output
-        info = json.loads(stdout)
+        info = await get_info(str(request.videoUrl), request.lite)
         
         # Get thumbnail URL
         thumbnail = None
@@ -176,7 +396,7 @@ async def get_video_info(request: DownloadRequest):
         if description and len(description) > 500:
             description = description[:500] + "..."
         
-        return InfoResponse(
+        response = InfoResponse(
             title=info.get('title', 'Unknown Title'),
             duration=info.get('duration'),
             uploader=info.get('uploader') or info.get('channel') or info.get('creator'),
@@ -191,61 +411,36 @@ async def get_video_info(request: DownloadRequest):
             description=description
         )
         
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=500, detail="Failed to parse video information")
+        return cached_json_response(response.model_dump_json().encode(), http_request)
+        
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 # Download Video
 @app.post("/download")
-async def download_video(request: DownloadRequest):
-    """Stream video download"""
+async def download_video(request: DownloadRequest, redirect: bool = False):
+    """Stream video download, or redirect to the media URL when possible"""
     try:
         # Get video info first for filename
-        cmd_info = [
-            'yt-dlp',
-            request.videoUrl,
-            '--dump-json',
-            '--no-playlist',
-            '--no-warnings',
-            '--no-call-home',
-            '--no-check-certificate'
-        ]
-        
-        process_info = await asyncio.create_subprocess_exec(
-            *cmd_info,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        
-        stdout_info, stderr_info = await process_info.communicate()
-        
-        if process_info.returncode != 0:
-            error_msg = stderr_info.decode().strip()
-            raise HTTPException(status_code=400, detail=f"yt-dlp error: {error_msg}")
-        
-        info = json.loads(stdout_info)
+        info = await get_info(str(request.videoUrl))
         title = sanitize_filename(info.get('title', 'video'))
         ext = info.get('ext', 'mp4')
         
         # Determine quality
         quality = request.quality
-        if quality not in ['best', 'worst', '720p', '480p', '360p']:
+        if quality not in FORMAT_MAP:
             quality = 'best'
         
-        # Map quality to yt-dlp format
-        format_map = {
-            'best': 'best[ext=mp4]/best',
-            'worst': 'worst[ext=mp4]/worst',
-            '720p': 'best[height<=720][ext=mp4]/best[height<=720]',
-            '480p': 'best[height<=480][ext=mp4]/best[height<=480]',
-            '360p': 'best[height<=360][ext=mp4]/best[height<=360]'
-        }
+        format_spec = FORMAT_MAP[quality]
         
-        format_spec = format_map.get(quality, 'best[ext=mp4]/best')
+        # Let the client fetch straight from the CDN when the URL allows it
+        if redirect:
+            direct_url = await resolve_direct_url(info, format_spec)
+            if direct_url:
+                return RedirectResponse(url=direct_url, status_code=303)
         
         # Stream the video
-        stream_generator = stream_yt_dlp(request.videoUrl, format_spec)
+        stream_generator = stream_yt_dlp(info, format_spec)
         
         filename = f"{title}.mp4"
         
@@ -268,49 +463,12 @@ async def download_video(request: DownloadRequest):
 async def download_format(request: DownloadRequest, format_id: str):
     """Download with specific format ID"""
     try:
-        cmd_info = [
-            'yt-dlp',
-            request.videoUrl,
-            '--dump-json',
-            '--no-playlist',
-            '--no-warnings'
-        ]
-        
-        process_info = await asyncio.create_subprocess_exec(
-            *cmd_info,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        
-        stdout_info, _ = await process_info.communicate()
-        info = json.loads(stdout_info)
+        info = await get_info(str(request.videoUrl))
         title = sanitize_filename(info.get('title', 'video'))
         
         # Stream with specific format
-        cmd = [
-            'yt-dlp',
-            request.videoUrl,
-            '-f', format_id,
-            '-o', '-',
-            '--no-playlist',
-            '--no-warnings'
-        ]
-        
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        
-        async def stream_output():
-            while True:
-                chunk = await process.stdout.read(8192)
-                if not chunk:
-                    break
-                yield chunk
-        
         return StreamingResponse(
-            stream_output(),
+            stream_yt_dlp(info, format_id),
             media_type="video/mp4",
             headers={
                 "Content-Disposition": f'attachment; filename="{title}.mp4"'
@@ -322,50 +480,50 @@ async def download_format(request: DownloadRequest, format_id: str):
 
 # Get available formats
 @app.post("/formats")
-async def get_formats(request: DownloadRequest):
+async def get_formats(request: DownloadRequest, http_request: Request):
     """Get all available formats for a video"""
     try:
-        cmd = [
-            'yt-dlp',
-            request.videoUrl,
-            '--dump-json',
-            '--no-playlist',
-            '--no-warnings'
-        ]
-        
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
+        info = await get_info(str(request.videoUrl), request.lite)
         
-        stdout, stderr = await process.communicate()
-        info = json.loads(stdout)
-        
-        formats = []
-        for f in info.get('formats', []):
-            if f.get('vcodec') != 'none' or f.get('acodec') != 'none':
-                formats.append({
-                    'format_id': f.get('format_id'),
-                    'ext': f.get('ext'),
-                    'quality': f.get('format_note') or f.get('quality') or 'Unknown',
-                    'filesize': f.get('filesize') or f.get('filesize_approx'),
-                    'vcodec': f.get('vcodec'),
-                    'acodec': f.get('acodec'),
-                    'height': f.get('height'),
-                    'width': f.get('width'),
-                    'fps': f.get('fps')
-                })
+        formats = [
+            {
+                'format_id': f.get('format_id'),
+                'ext': f.get('ext'),
+                'quality': f.get('format_note') or f.get('quality') or 'Unknown',
+                'filesize': f.get('filesize') or f.get('filesize_approx'),
+                'vcodec': f.get('vcodec'),
+                'acodec': f.get('acodec'),
+                'height': f.get('height'),
+                'width': f.get('width'),
+                'fps': f.get('fps')
+            }
+            for f in info.get('formats', [])
+            if f.get('vcodec') != 'none' or f.get('acodec') != 'none'
+        ]
         
-        return {
+        # Serialize with orjson directly - skips FastAPI's jsonable_encoder walk
+        content = orjson.dumps({
             'title': info.get('title'),
             'formats': formats,
             'format_count': len(formats)
-        }
+        })
+        
+        return cached_json_response(content, http_request)
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", 8080)))
+    # Multiple workers need an import string; each gets its own event loop,
+    # yt-dlp semaphore and in-process cache (set REDIS_URL to share info).
+    # "auto" picks uvloop/httptools when installed (uvloop isn't on Windows).
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", 8080)),
+        loop="auto",
+        http="auto",
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        backlog=2048
+    )